@@ -1,34 +1,157 @@
 import os
-import glob
+import sys
+import mmap
 import re
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Generator
 
+CHUNK_SIZE = 16 * 1024 * 1024  # user-space copy step, large enough for NVMe readahead to keep up
+PROGRESS_INTERVAL = 0.5  # seconds between merge progress reports
+_IMEC_FOLDER_RE = re.compile(r'imec[0-3]')
+_IMEC_RE = re.compile(r'imec(\d+)')
+
 class NeuropixelsMerger:
     '''
     This project provides a Python-based tool for merging `.bin` files from IMEC Neuropixels recordings. It ensures efficient handling of large binary files and maintains accurate metadata updates during the merging process. 
     The script identifies corresponding `.bin` and `.meta` files in different directories and combines them while preserving file structure and metadata integrity.
     Author: https://github.com/mohamedsbadawy
     '''
-    def __init__(self, dir1: str, dir2: str, output_dir: str, extension: str,time_range1:tuple=None,time_range2:tuple=None):
+    def __init__(self, dir1: str, dir2: str, output_dir: str, extension: str,time_range1:tuple=None,time_range2:tuple=None,
+                 max_workers: int = 1):
         self.dir1 = dir1
         self.dir2 = dir2
         self.output_dir = output_dir
         self.extension = extension
         self.time_range1 = time_range1
         self.time_range2 = time_range2
-        self.totalSize = None
+        # Size in bytes of every merged output file, keyed by its path
+        self.merged_sizes: Dict[str, int] = {}
+        self._meta_cache: Dict[str, Dict[str, str]] = {}
+        # Folder listings and imec maps are the same for the .bin and .meta passes, so each directory is scanned once
+        self._files_cache: Dict[tuple, Dict[str, List[str]]] = {}
+        self._imec_map_cache: Dict[str, Dict[str, str]] = {}
+        # Number of file pairs merged concurrently (one process each). Serial by default: worker
+        # processes need the caller's script to guard its entry point with if __name__ == '__main__'
+        self.max_workers = max_workers
         os.makedirs(output_dir, exist_ok=True)
     
-    def read_file_chunks(self, file_path: str, chunk_size: int = 128 * 1024 * 1024) -> Generator[bytes, None, None]:
-        """Generator to read a file in chunks."""
+    def read_file_chunks(self, file_path: str, chunk_size: int = 128 * 1024 * 1024) -> Generator[memoryview, None, None]:
+        """
+        Generator to read a file in chunks. A single buffer is reused for every chunk, so each
+        yielded view is only valid until the next one is requested.
+        """
         try:
             with open(file_path, 'rb') as f:
-                while chunk := f.read(chunk_size):
-                    yield chunk
+                buf = memoryview(bytearray(chunk_size))
+                while n := f.readinto(buf):
+                    yield buf[:n]
         except IOError as e:
             print(f"Error reading file {file_path}: {e}")
             raise
+
+    def prefetch(self, fd: int, offset: int, length: int):
+        """Asks the kernel to start reading [offset, offset + length) of fd in the background."""
+        if length > 0 and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+
+    def advise_sequential(self, fd: int, start: int, end: int):
+        """Tells the kernel that [start, end) of fd is read sequentially, which enlarges its readahead window."""
+        if end > start and hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_SEQUENTIAL)
+
+    def preallocate(self, fd: int, size: int):
+        """Reserves size bytes for fd up front, so the filesystem can allocate contiguous extents."""
+        if size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except OSError:
+                # Not supported by every filesystem (e.g. some network mounts); the copy works without it
+                pass
+
+    def copy_range(self, src_fd: int, dst_fd: int, start: int, end: int,
+                   step: int = 128 * 1024 * 1024, next_segment: tuple = None) -> Generator[int, None, None]:
+        """
+        Copies bytes [start, end) of src_fd to the current position of dst_fd inside the kernel,
+        yielding the number of bytes copied per step. Uses copy_file_range (reflink-capable) when
+        both files share a filesystem and sendfile otherwise, and falls back to copy_range_buffered
+        when neither is supported. Linux only.
+
+        While a step is copied the next one is prefetched, so reads stay in flight on the device.
+        next_segment (fd, start, end) is the segment copied after this one; its head is prefetched
+        during the last step so the switch between input files does not stall on a cold read.
+        """
+        self.advise_sequential(src_fd, start, end)
+        same_fs = hasattr(os, 'copy_file_range') and os.fstat(src_fd).st_dev == os.fstat(dst_fd).st_dev
+        offset = start
+        while offset < end:
+            count = min(step, end - offset)
+            if offset + count < end:
+                self.prefetch(src_fd, offset + count, min(step, end - offset - count))
+            elif next_segment is not None:
+                next_fd, next_start, next_end = next_segment
+                self.prefetch(next_fd, next_start, min(step, next_end - next_start))
+            # offset < end here, so a 0 return is not end of file: some filesystems and special files
+            # report an unsupported copy that way instead of raising
+            if same_fs:
+                try:
+                    sent = os.copy_file_range(src_fd, dst_fd, count, offset)
+                except OSError:
+                    sent = 0
+                if not sent:
+                    # Older kernels / filesystems without support: retry this step with sendfile
+                    same_fs = False
+                    continue
+            else:
+                try:
+                    sent = os.sendfile(dst_fd, src_fd, offset, count)
+                except OSError:
+                    sent = 0
+                if not sent:
+                    # Neither in-kernel copy works here (e.g. some FUSE/network filesystems or sandboxes):
+                    # finish the segment through user space, continuing at the current output position
+                    with open(src_fd, 'rb', closefd=False) as src, open(dst_fd, 'wb', closefd=False) as dst:
+                        yield from self.copy_range_buffered(src, dst, offset, end)
+                    return
+            offset += sent
+            yield sent
+
+    def copy_range_mmap(self, src, dst, start: int, end: int,
+                        step: int = CHUNK_SIZE) -> Generator[int, None, None]:
+        """
+        Copies bytes [start, end) of src to dst by writing memoryview slices of a read-only
+        mapping of src, so no intermediate bytes objects are allocated.
+        """
+        end = min(end, os.fstat(src.fileno()).st_size)
+        if end <= start:
+            return
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mm, 'madvise'):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            view = memoryview(mm)
+            try:
+                for offset in range(start, end, step):
+                    yield dst.write(view[offset:min(offset + step, end)])
+            finally:
+                view.release()
+
+    def copy_range_buffered(self, src, dst, start: int, end: int,
+                            chunk_size: int = CHUNK_SIZE) -> Generator[int, None, None]:
+        """Portable fallback for copy_range: copies bytes [start, end) of src to dst through user space."""
+        to_read = end - start
+        if to_read <= 0:
+            return
+        self.advise_sequential(src.fileno(), start, end)
+        src.seek(start)
+        buf = memoryview(bytearray(min(chunk_size, to_read)))
+        while to_read > 0:
+            n = src.readinto(buf[:min(len(buf), to_read)])
+            if not n:
+                break
+            dst.write(buf[:n])
+            to_read -= n
+            yield n
     
     def merge_ap_bin(
         self,
@@ -39,7 +162,7 @@ class NeuropixelsMerger:
         file2_time_range: tuple[float, float] = None,
         meta1_path: str = None,
         meta2_path: str = None
-    ) -> None:
+    ) -> int:
         """
         Merges two .ap.bin files, optionally including only selected time ranges.
 
@@ -49,13 +172,12 @@ class NeuropixelsMerger:
             file1_time_range, file2_time_range (tuple[float, float], optional): 
                 Time ranges in seconds for each file.
             meta1_path, meta2_path (str, optional): Paths to .meta files (needed for sampling rate).
+
+        Returns:
+            int: Number of bytes merged into the output file.
         """
         def get_byte_range(meta_path, time_range):
-            with open(meta_path, 'r') as f:
-                lines = f.readlines()
-            meta = {line.split('=')[0]: line.split('=')[1].strip() for line in lines}
-            fs = float(meta['imSampRate'])
-            n_ch = int(meta['nSavedChans'])
+            fs, n_ch = self.read_sample_format(meta_path)
 
             start_sample = int(time_range[0] * fs)
             end_sample = int(time_range[1] * fs)
@@ -63,6 +185,9 @@ class NeuropixelsMerger:
             end_byte = end_sample * n_ch * 2
             return start_byte, end_byte
 
+        # Data is copied under a temporary name and renamed when complete, so an interrupted
+        # merge never leaves a preallocated, partly zero-filled file under the output name
+        part_file = output_file + '.part'
         try:
             # Compute byte ranges from time ranges
             size1 = os.path.getsize(file1)
@@ -76,88 +201,205 @@ class NeuropixelsMerger:
                 f1_start, f1_end = get_byte_range(meta1_path, file1_time_range)
             if file2_time_range and meta2_path:
                 f2_start, f2_end = get_byte_range(meta2_path, file2_time_range)
+            # A time range running past the end of a recording only covers the bytes that exist
+            f1_start, f1_end = min(f1_start, size1), min(f1_end, size1)
+            f2_start, f2_end = min(f2_start, size2), min(f2_end, size2)
 
             total_size = (f1_end - f1_start) + (f2_end - f2_start)
             bytes_written = 0
 
-            print(f"Merging:")
-            print(f"  {file1} bytes {f1_start} to {f1_end}")
-            print(f"  {file2} bytes {f2_start} to {f2_end}")
-            print(f"Output: {output_file}")
+            # One print call, so the header of a pair stays together when workers share the terminal
+            print(f"Merging:\n  {file1} bytes {f1_start} to {f1_end}\n  {file2} bytes {f2_start} to {f2_end}\n"
+                  f"Output: {output_file}", flush=True)
             if not os.path.exists(output_file):
-                with open(output_file, 'wb') as outfile:
-                    for path, start, end in [(file1, f1_start, f1_end), (file2, f2_start, f2_end)]:
-                        with open(path, 'rb') as f:
-                            f.seek(start)
-                            to_read = end - start
-                            while to_read > 0:
-                                chunk = f.read(min(1024 * 1024, to_read))
-                                if not chunk:
-                                    break
-                                outfile.write(chunk)
-                                to_read -= len(chunk)
-                                bytes_written += len(chunk)
-                                print(f"Progress: {bytes_written / total_size * 100:.2f}%", end='\r')
-
-                print("\nMerging complete.")
+                use_kernel_copy = sys.platform.startswith('linux')
+                # 32-bit interpreters cannot map multi-GB recordings
+                use_mmap = sys.maxsize > 2 ** 32
+                # Parallel workers would overwrite each other's '\r' progress line, so only a serial merge reports it
+                show_progress = self.max_workers == 1
+                next_report = time.monotonic() + PROGRESS_INTERVAL
+                with open(part_file, 'wb') as outfile, open(file1, 'rb') as in1, open(file2, 'rb') as in2:
+                    self.preallocate(outfile.fileno(), total_size)
+                    segments = [(in1, f1_start, f1_end), (in2, f2_start, f2_end)]
+                    for i, (f, start, end) in enumerate(segments):
+                        if use_kernel_copy:
+                            next_segment = None
+                            if i + 1 < len(segments):
+                                next_f, next_start, next_end = segments[i + 1]
+                                next_segment = (next_f.fileno(), next_start, next_end)
+                            copied = self.copy_range(f.fileno(), outfile.fileno(), start, end,
+                                                     next_segment=next_segment)
+                        elif use_mmap:
+                            copied = self.copy_range_mmap(f, outfile, start, end)
+                        else:
+                            copied = self.copy_range_buffered(f, outfile, start, end)
+                        for n in copied:
+                            bytes_written += n
+                            if not show_progress:
+                                continue
+                            now = time.monotonic()
+                            if now >= next_report:
+                                # Flushed here, at the throttled report points only: stdout is block-buffered
+                                # when redirected to a file or pipe, so each report costs a single write
+                                print(f"Progress: {bytes_written / total_size * 100:.2f}%", end='\r', flush=True)
+                                next_report = now + PROGRESS_INTERVAL
+                    if bytes_written != total_size:
+                        # Segment bounds are clamped to the input sizes, so a short copy means it failed
+                        raise OSError(f"Copied {bytes_written} of {total_size} bytes into {part_file}")
+                os.replace(part_file, output_file)
+                if show_progress:
+                    print("\nMerging complete.", flush=True)
+                else:
+                    print(f"Merging complete: {output_file}", flush=True)
+                return bytes_written
+            # An existing output is only reused when it holds exactly what this merge would write
+            existing_size = os.path.getsize(output_file)
+            if existing_size != total_size:
+                raise FileExistsError(f"{output_file} already exists with {existing_size} bytes, expected "
+                                      f"{total_size}; remove it to merge again")
+            print("Output already exists, skipping.")
             return total_size
-        except Exception as e:
-            print(f"Error merging files: {e}")
-            if os.path.exists(output_file):
-                os.remove(output_file)
+        except BaseException as e:
+            # BaseException so that Ctrl-C (KeyboardInterrupt) also removes the partial copy
+            print(f"Error merging files: {e!r}")
+            if os.path.exists(part_file):
+                os.remove(part_file)
             raise
 
     def get_ap_bin_files(self, directory: str, ext=None) -> Dict[str, List[str]]:
+        """Finds .ap.bin files in the imec0-imec3 subdirectories, using one directory listing per level."""
         if ext is None:
             ext = self.extension
-        """Finds .ap.bin files in subdirectories."""
+        if (directory, ext) in self._files_cache:
+            return self._files_cache[(directory, ext)]
+        if not os.path.isdir(directory):
+            return {}
+        suffix = f".{ext}"
         ap_bin_files = {}
-        for imec_folder in ["imec0", "imec1", "imec2", "imec3"]:
-            matching_folders = glob.glob(str(Path(directory) / f"*{imec_folder}*"))
-            for folder in matching_folders:
-                if os.path.isdir(folder):
-                    bin_files = sorted(glob.glob(os.path.join(folder, f"*.{ext}")))
-                    if bin_files:
-                        ap_bin_files[folder] = bin_files
+        with os.scandir(directory) as folders:
+            for folder in folders:
+                # is_dir() is answered from the directory listing itself, without an extra stat
+                if not _IMEC_FOLDER_RE.search(folder.name) or not folder.is_dir():
+                    continue
+                with os.scandir(folder.path) as entries:
+                    bin_files = sorted(entry.path for entry in entries
+                                       if entry.name.endswith(suffix) and not entry.name.startswith(".")
+                                       and entry.is_file())
+                if bin_files:
+                    ap_bin_files[folder.path] = bin_files
+        self._files_cache[(directory, ext)] = ap_bin_files
         return ap_bin_files
 
+    def get_imec_map(self, directory: str) -> Dict[str, str]:
+        """Maps imec numbers to the folders of get_ap_bin_files(directory) that hold them."""
+        if directory not in self._imec_map_cache:
+            self._imec_map_cache[directory] = {self.extract_imec_number(k): k for k in self.get_ap_bin_files(directory)}
+        return self._imec_map_cache[directory]
+
+    def meta_path(self, bin_path: str) -> str:
+        """Returns the .meta file that belongs to a .bin file."""
+        if not bin_path.endswith(".bin"):
+            raise ValueError(f"Not a .bin file: {bin_path}")
+        return bin_path[:-len(".bin")] + ".meta"
+
     def extract_imec_number(self, folder_name: str) -> str:
-        """Extracts the imec number from a folder name."""
-        match = re.search(r'imec(\d+)', folder_name)
+        """Extracts the imec number from a folder name (parent directories are ignored)."""
+        match = _IMEC_RE.search(os.path.basename(folder_name))
         return match.group(1) if match else None
 
-    def merge_matching_files(self):
-        """Matches and merges corresponding .ap.bin files."""
+    def get_merge_tasks(self) -> List[tuple]:
+        """Lists (file1, file2, output_file) for every pair of matching .ap.bin files, creating output folders."""
         files1, files2 = self.get_ap_bin_files(self.dir1), self.get_ap_bin_files(self.dir2)
+        imec_map1, imec_map2 = self.get_imec_map(self.dir1), self.get_imec_map(self.dir2)
 
-        imec_map1 = {self.extract_imec_number(k): k for k in files1}
-        imec_map2 = {self.extract_imec_number(k): k for k in files2}
-        
+        tasks = []
         for imec_num in set(imec_map1.keys()) & set(imec_map2.keys()):
-            for file1, file2 in zip(files1[imec_map1[imec_num]], files2[imec_map2[imec_num]]):
-                output_folder = Path(self.output_dir) / Path(file1).parent.relative_to(self.dir1)
-                output_folder.mkdir(parents=True, exist_ok=True)
-                total_size = self.merge_ap_bin(file1, file2, str(output_folder / Path(file1).name),
-                                               file1_time_range=self.time_range1,file2_time_range=self.time_range2,meta1_path=file1.replace(".bin",".meta"),meta2_path=file2.replace(".bin",".meta"))
-        self.totalSize = total_size
+            folder1, folder2 = imec_map1[imec_num], imec_map2[imec_num]
+            # All files of a probe share one output folder, so resolve it once per folder, not per file
+            output_folder = Path(self.output_dir) / Path(folder1).relative_to(self.dir1)
+            output_folder.mkdir(parents=True, exist_ok=True)
+            output_folder = str(output_folder)
+            for file1, file2 in zip(files1[folder1], files2[folder2]):
+                tasks.append((file1, file2, os.path.join(output_folder, os.path.basename(file1))))
+        return tasks
+
+    def run_tasks(self, func, tasks: List[tuple]) -> List:
+        """Calls func(*task) for every task and returns the results in order."""
+        # Every file pair is independent, so probes are merged in parallel worker processes
+        if self.max_workers > 1 and len(tasks) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.max_workers, len(tasks))) as executor:
+                futures = [executor.submit(func, *task) for task in tasks]
+                return [future.result() for future in futures]
+        return [func(*task) for task in tasks]
+
+    def merge_matching_files(self):
+        """Matches and merges corresponding .ap.bin files, recording each output's size for fix_meta_files."""
+        tasks = self.get_merge_tasks()
+        sizes = self.run_tasks(self.merge_ap_bin, [
+            (file1, file2, output_file, self.time_range1, self.time_range2, self.meta_path(file1), self.meta_path(file2))
+            for file1, file2, output_file in tasks])
+        self.merged_sizes.update((output_file, size) for (_, _, output_file), size in zip(tasks, sizes))
+
+    def merge_pair(self, file1: str, file2: str, output_file: str) -> int:
+        """Merges one pair of .ap.bin files and writes the merged .meta next to the output right away."""
+        meta1_path, meta2_path = self.meta_path(file1), self.meta_path(file2)
+        # Parsed before merging, so the time-range lookup in merge_ap_bin is answered from the cache
+        meta1, meta2 = self.read_meta(meta1_path), self.read_meta(meta2_path)
+        total_bytes = self.merge_ap_bin(file1, file2, output_file, self.time_range1, self.time_range2,
+                                        meta1_path, meta2_path)
+        merged_meta = self.merge_meta(meta1, meta2, total_bytes=total_bytes)
+        self.write_meta(self.meta_path(output_file), merged_meta)
+        return total_bytes
+
+    def merge_all(self) -> List[int]:
+        """
+        Merges all matching .ap.bin files and their .meta files in a single pass.
+        Each merged .meta gets the exact byte count of its own merged .bin file.
+        """
+        tasks = self.get_merge_tasks()
+        sizes = self.run_tasks(self.merge_pair, tasks)
+        self.merged_sizes.update((output_file, size) for (_, _, output_file), size in zip(tasks, sizes))
+        return sizes
 
     def read_meta(self, meta_path: str) -> Dict[str, str]:
-        """Reads an ap.meta file into a dictionary."""
-        meta_data = {}
+        """Reads an ap.meta file into a dictionary. Files are parsed once and served from a cache afterwards."""
+        if meta_path not in self._meta_cache:
+            with open(meta_path, "r") as file:
+                # Split on the first '=' only: values such as ~snsChanMap may contain '=' themselves
+                self._meta_cache[meta_path] = dict(line.split("=", 1) for line in file.read().splitlines() if "=" in line)
+        # Hand out a copy so callers (e.g. merge_meta) can modify it without touching the cache
+        return dict(self._meta_cache[meta_path])
+
+    def read_sample_format(self, meta_path: str) -> tuple:
+        """
+        Returns (imSampRate, nSavedChans) of an ap.meta file. Unless the file is already cached,
+        it is scanned only up to the line where both keys have been seen.
+        """
+        if meta_path in self._meta_cache:
+            meta = self._meta_cache[meta_path]
+            return float(meta['imSampRate']), int(meta['nSavedChans'])
+        fs = n_ch = None
         with open(meta_path, "r") as file:
             for line in file:
-                key, value = line.strip().split("=")
-                meta_data[key] = value
-        return meta_data
+                if line.startswith("imSampRate="):
+                    fs = float(line[len("imSampRate="):])
+                elif line.startswith("nSavedChans="):
+                    n_ch = int(line[len("nSavedChans="):])
+                if fs is not None and n_ch is not None:
+                    return fs, n_ch
+        raise KeyError('imSampRate' if fs is None else 'nSavedChans')
 
-    def merge_meta(self, meta1: Dict[str, str], meta2: Dict[str, str]) -> Dict[str, str]:
-        """Merges two ap.meta dictionaries."""
+    def merge_meta(self, meta1: Dict[str, str], meta2: Dict[str, str], total_bytes: int = None) -> Dict[str, str]:
+        """
+        Merges two ap.meta dictionaries. total_bytes, the size of the merged .bin file,
+        takes precedence over the summed sizes (which are wrong when time ranges are used).
+        """
         fs = float(meta1['imSampRate'])
         n_ch = int(meta1['nSavedChans'])
         temp_meta = meta1
-        if self.totalSize is not None:
-            temp_meta['fileSizeBytes'] = self.totalSize
-            temp_meta['fileTimeSecs'] = self.totalSize / (2 * n_ch * fs)
+        if total_bytes is not None:
+            temp_meta['fileSizeBytes'] = str(total_bytes)
+            temp_meta['fileTimeSecs'] = str(total_bytes / (2 * n_ch * fs))
             temp_meta['firstSample'] = str(min(int(meta1["firstSample"]), int(meta2["firstSample"])))
             return temp_meta
         else:
@@ -175,17 +417,8 @@ class NeuropixelsMerger:
 
     def fix_meta_files(self):
         """Fixes and merges corresponding .meta files."""
-        ext = self.extension.replace(".bin", ".meta")
-        files1, files2 = self.get_ap_bin_files(self.dir1,ext), self.get_ap_bin_files(self.dir2,ext)
-        imec_map1 = {self.extract_imec_number(k): k for k in files1}
-        imec_map2 = {self.extract_imec_number(k): k for k in files2}
-        
-        for imec_num in set(imec_map1.keys()) & set(imec_map2.keys()):
-            for file1, file2 in zip(files1[imec_map1[imec_num]], files2[imec_map2[imec_num]]):
-                meta1, meta2 = self.read_meta(file1), self.read_meta(file2)
-                merged_meta = self.merge_meta(meta1, meta2)
-                output_folder = Path(self.output_dir) / Path(file1).parent.relative_to(self.dir2)
-                output_folder.mkdir(parents=True, exist_ok=True)
-                self.write_meta(str(output_folder / Path(file1).name), merged_meta)
-
-
+        # The .meta files sit next to the .bin files, so reuse the (cached) .bin listing instead of scanning again
+        for file1, file2, output_file in self.get_merge_tasks():
+            meta1, meta2 = self.read_meta(self.meta_path(file1)), self.read_meta(self.meta_path(file2))
+            merged_meta = self.merge_meta(meta1, meta2, total_bytes=self.merged_sizes.get(output_file))
+            self.write_meta(self.meta_path(output_file), merged_meta)